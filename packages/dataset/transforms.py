@@ -11,6 +11,9 @@ class Augmentation(object):
         self.img_size = img_size
         self.pixel_mean = pixel_mean
         self.pixel_std = pixel_std
+        # [3, 1, 1], broadcast over the image
+        self.mean = torch.tensor(pixel_mean).view(3, 1, 1)
+        self.std = torch.tensor(pixel_std).view(3, 1, 1)
         self.jitter = jitter
         self.hue = hue
         self.saturation = saturation
@@ -106,7 +109,8 @@ class Augmentation(object):
         
 
     def to_tensor(self, video_clip):
-        return [F.normalize(F.to_tensor(image), self.pixel_mean, self.pixel_std) for image in video_clip]
+        # to_tensor returns a new tensor, so it is normalized in place
+        return [F.to_tensor(image).sub_(self.mean).div_(self.std) for image in video_clip]
 
 
     def __call__(self, video_clip, target):
@@ -149,9 +153,13 @@ class BaseTransform(object):
         self.img_size = img_size
         self.pixel_mean = pixel_mean
         self.pixel_std = pixel_std
+        # [3, 1, 1], broadcast over the image
+        self.mean = torch.tensor(pixel_mean).view(3, 1, 1)
+        self.std = torch.tensor(pixel_std).view(3, 1, 1)
 
     def to_tensor(self, video_clip):
-        return [F.normalize(F.to_tensor(image), self.pixel_mean, self.pixel_std) for image in video_clip]
+        # to_tensor returns a new tensor, so it is normalized in place
+        return [F.to_tensor(image).sub_(self.mean).div_(self.std) for image in video_clip]
 
 
     def __call__(self, video_clip, target=None, normalize=True):
@@ -5,12 +5,33 @@ import os
 import random
 import numpy as np
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from torch.utils.data import Dataset
 from PIL import Image
 
 
+def load_frame(path):
+    """ decode a frame as an RGB image """
+    frame = Image.open(path)
+    if frame.mode != 'RGB':
+        return frame.convert('RGB')
+    # jpeg frames are decoded straight to RGB, so skip the extra copy of convert()
+    frame.load()
+
+    return frame
+
+
+def load_label(path):
+    """ parse a label file: [[label, x1, y1, x2, y2], ...] """
+    # np.loadtxt tokenizes line by line in python, split() on the whole file is much faster
+    with open(path, 'r') as f:
+        label = np.array(f.read().split(), dtype=np.float64)
+
+    return label.reshape(-1, 5)
+
+
 # Dataset for UCF24 & JHMDB
 class UCF_JHMDB_Dataset(Dataset):
     def __init__(self,
@@ -20,7 +41,8 @@ class UCF_JHMDB_Dataset(Dataset):
                  transform=None,
                  is_train=False,
                  len_clip=16,
-                 sampling_rate=1):
+                 sampling_rate=1,
+                 num_load_threads=4):
         self.data_root = data_root
         self.dataset = dataset
         self.transform = transform
@@ -29,6 +51,7 @@ class UCF_JHMDB_Dataset(Dataset):
         self.img_size = img_size
         self.len_clip = len_clip
         self.sampling_rate = sampling_rate
+        self.num_load_threads = num_load_threads
             
         if self.is_train:
             self.split_list = 'trainlist.txt'
@@ -43,8 +66,44 @@ class UCF_JHMDB_Dataset(Dataset):
 
         if dataset == 'ucf24':
             self.num_classes = 24
+            self.frame_format = '{:05d}.jpg'
         elif dataset == 'jhmdb21':
             self.num_classes = 21
+            self.frame_format = '{:05d}.png'
+
+        # frame numbers of each video, counted once instead of per sample
+        self.frame_counts = {}
+        for image_path in self.file_names:
+            img_split = image_path.rstrip().split('/')
+            video_key = (img_split[1], img_split[2])
+            if video_key not in self.frame_counts:
+                img_folder = os.path.join(data_root, 'rgb-images', img_split[1], img_split[2])
+                with os.scandir(img_folder) as it:
+                    max_num = sum(1 for _ in it)
+                if self.dataset == 'jhmdb21':
+                    max_num -= 1
+                self.frame_counts[video_key] = max_num
+
+        # parse the split list once, so that pull_item only indexes into it
+        self.img_ids = np.zeros(self.num_samples, dtype=np.int32)
+        self.max_nums = np.zeros(self.num_samples, dtype=np.int32)
+        self.img_folders = []
+        self.label_paths = []
+        self.frame_ids = []
+        for index, image_path in enumerate(self.file_names):
+            img_split = image_path.rstrip().split('/')  # ex. ['labels', 'Basketball', 'v_Basketball_g08_c01', '00070.txt']
+            # image name
+            img_id = int(img_split[-1][:5])
+            self.img_ids[index] = img_id
+
+            # frame numbers
+            self.max_nums[index] = self.frame_counts[(img_split[1], img_split[2])]
+
+            # image folder
+            self.img_folders.append(os.path.join(data_root, 'rgb-images', img_split[1], img_split[2]))
+            # path to label
+            self.label_paths.append(os.path.join(data_root, img_split[0], img_split[1], img_split[2], '{:05d}.txt'.format(img_id)))
+            self.frame_ids.append(img_split[1] + '_' + img_split[2] + '_' + img_split[3])
 
 
     def __len__(self):
@@ -53,32 +112,20 @@ class UCF_JHMDB_Dataset(Dataset):
 
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
-        image_path = self.file_names[index].rstrip()
 
         # load a data
-        frame_idx, video_clip, target = self.pull_item(image_path)
+        frame_idx, video_clip, target = self.pull_item(index)
 
         return frame_idx, video_clip, target
 
 
-    def pull_item(self, image_path):
+    def pull_item(self, index):
         """ load a data """
-
-        img_split = image_path.split('/')  # ex. ['labels', 'Basketball', 'v_Basketball_g08_c01', '00070.txt']
-        # image name
-        img_id = int(img_split[-1][:5])
-
-        # path to label
-        label_path = os.path.join(self.data_root, img_split[0], img_split[1], img_split[2], '{:05d}.txt'.format(img_id))
-
-        # image folder
-        img_folder = os.path.join(self.data_root, 'rgb-images', img_split[1], img_split[2])
-
-        # frame numbers
-        if self.dataset == 'ucf24':
-            max_num = len(os.listdir(img_folder))
-        elif self.dataset == 'jhmdb21':
-            max_num = len(os.listdir(img_folder)) - 1
+        img_id = int(self.img_ids[index])
+        max_num = int(self.max_nums[index])
+        img_folder = self.img_folders[index]
+        label_path = self.label_paths[index]
+        frame_id = self.frame_ids[index]
 
         # sampling rate
         if self.is_train:
@@ -86,8 +133,8 @@ class UCF_JHMDB_Dataset(Dataset):
         else:
             d = self.sampling_rate
 
-        # load images
-        video_clip = []
+        # frame paths
+        frame_paths = []
         for i in reversed(range(self.len_clip)):
             # make it as a loop
             img_id_temp = img_id - i * d
@@ -96,23 +143,19 @@ class UCF_JHMDB_Dataset(Dataset):
             elif img_id_temp > max_num:
                 img_id_temp = max_num
 
-            # load a frame
-            if self.dataset == 'ucf24':
-                path_tmp = os.path.join(self.data_root, 'rgb-images', img_split[1], img_split[2] ,'{:05d}.jpg'.format(img_id_temp))
-            elif self.dataset == 'jhmdb21':
-                path_tmp = os.path.join(self.data_root, 'rgb-images', img_split[1], img_split[2] ,'{:05d}.png'.format(img_id_temp))
-            frame = Image.open(path_tmp).convert('RGB')
-            ow, oh = frame.width, frame.height
+            path_tmp = os.path.join(img_folder, self.frame_format.format(img_id_temp))
+            frame_paths.append(path_tmp)
 
-            video_clip.append(frame)
-
-            frame_id = img_split[1] + '_' +img_split[2] + '_' + img_split[3]
+        # load images, PIL releases the GIL while decoding
+        if self.num_load_threads > 1:
+            with ThreadPoolExecutor(max_workers=self.num_load_threads) as executor:
+                video_clip = list(executor.map(load_frame, frame_paths))
+        else:
+            video_clip = [load_frame(path_tmp) for path_tmp in frame_paths]
+        ow, oh = video_clip[-1].width, video_clip[-1].height
 
         # load an annotation
-        if os.path.getsize(label_path):
-            target = np.loadtxt(label_path)
-        else:
-            target = None
+        target = load_label(label_path)
 
         # [label, x1, y1, x2, y2] -> [x1, y1, x2, y2, label]
         label = target[..., :1]
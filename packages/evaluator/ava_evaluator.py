@@ -54,6 +54,10 @@ class AVA_Evaluator(object):
             self.class_whitelist = set(list(self.class_whitelist)[:14])
             self.categories = self.categories[:14]
 
+        # boolean mask over the class ids [0, 80], 0 is the background
+        self.whitelist_mask = np.zeros(81, dtype=bool)
+        self.whitelist_mask[list(self.class_whitelist)] = True
+
         # create output_json file
         os.makedirs(self.backup_dir, exist_ok=True)
         self.backup_dir = os.path.join(self.backup_dir, 'ava_{}'.format(version))
@@ -70,7 +74,10 @@ class AVA_Evaluator(object):
             sampling_rate=sampling_rate
         )
         self.num_classes = self.testset.num_classes
-        self.all_preds = []
+        # detections of all key frames
+        self.boxes_list = []        # List[N, 4]
+        self.scores_list = []       # List[N, C]
+        self.video_info_list = []   # List[N, 2]
 
         # dataloader
         self.testloader = torch.utils.data.DataLoader(
@@ -83,6 +90,16 @@ class AVA_Evaluator(object):
             pin_memory=True
         )
 
+        # stream inference carries the model state from one key frame to the next,
+        # so the samples are not batched but still decoded ahead by the workers
+        self.streamloader = torch.utils.data.DataLoader(
+            dataset=self.testset,
+            batch_size=None,
+            shuffle=False,
+            num_workers=4,
+            pin_memory=True
+        )
+
     def get_ava_mini_groundtruth(self, full_groundtruth):
         """
         Get the groundtruth annotations corresponding the "subset" of AVA val set.
@@ -151,35 +168,57 @@ class AVA_Evaluator(object):
 
         return image_paths, video_idx_to_name
 
-    def update_stats(self, preds):
-        self.all_preds.extend(preds)
+    def update_stats(self, boxes, scores, video_info):
+        """
+            boxes: (ndarray) [N, 4] -> [x1, y1, x2, y2] of the key frame
+            scores: (ndarray) [N, C]
+            video_info: (List) [video_idx, sec] of the key frame
+        """
+        self.boxes_list.append(boxes)
+        self.scores_list.append(scores)
+        self.video_info_list.append(np.tile(np.asarray(video_info, dtype=np.float64), (len(boxes), 1)))
+
+    def reset_stats(self):
+        self.boxes_list = []
+        self.scores_list = []
+        self.video_info_list = []
 
     def get_ava_eval_data(self):
         out_scores = defaultdict(list)
         out_labels = defaultdict(list)
         out_boxes = defaultdict(list)
-        count = 0
-
-        # each pred is [[x1, y1, x2, y2], cls_out, [video_idx, src]]
-        for i in range(len(self.all_preds)):
-            pred = self.all_preds[i]
-            assert len(pred) == 3
-            video_idx = int(np.round(pred[-1][0]))
-            sec = int(np.round(pred[-1][1]))
-            box = pred[0]
-            cls_out = pred[1]
-            assert len(cls_out) == 80
 
+        if len(self.boxes_list) == 0:
+            return out_boxes, out_labels, out_scores
+
+        # boxes: [M, 4] -> [x1, y1, x2, y2], cls_out: [M, 80], video_info: [M, 2]
+        boxes = np.concatenate(self.boxes_list)
+        cls_out = np.concatenate(self.scores_list)
+        video_info = np.concatenate(self.video_info_list)
+        assert cls_out.shape[1] == 80
+
+        # cls_out[:, i] is the score of class id i + 1
+        keep = self.whitelist_mask[1:]
+        keep_labels = np.nonzero(keep)[0] + 1
+        num_keep = len(keep_labels)
+
+        boxes = boxes[:, [1, 0, 3, 2]]  # turn to y1,x1,y2,x2
+        scores = cls_out[:, keep]
+        video_info = np.round(video_info).astype(np.int64)
+
+        # group the preds by (video_idx, sec), keeping their order in each group
+        frame_info, frame_inds = np.unique(video_info, axis=0, return_inverse=True)
+        frame_inds = frame_inds.reshape(-1)
+        order = np.argsort(frame_inds, kind='stable')
+        splits = np.cumsum(np.bincount(frame_inds, minlength=len(frame_info)))[:-1]
+
+        for (video_idx, sec), inds in zip(frame_info, np.split(order, splits)):
             video = self.video_idx_to_name[video_idx]
             key = video + ',' + "%04d" % (sec)
-            box = [box[1], box[0], box[3], box[2]]  # turn to y1,x1,y2,x2
 
-            for cls_idx, score in enumerate(cls_out):
-                if cls_idx + 1 in self.class_whitelist:
-                    out_scores[key].append(score)
-                    out_labels[key].append(cls_idx + 1)
-                    out_boxes[key].append(box)
-                    count += 1
+            out_scores[key] = scores[inds].reshape(-1).tolist()
+            out_labels[key] = np.tile(keep_labels, len(inds)).tolist()
+            out_boxes[key] = np.repeat(boxes[inds], num_keep, axis=0).tolist()
 
         return out_boxes, out_labels, out_scores
 
@@ -215,7 +254,7 @@ class AVA_Evaluator(object):
         # inference
         prev_video_id = ''
         prev_video_sec = ''
-        for iter_i, (key_frame_info, video_clip, target) in enumerate(self.testset):
+        for iter_i, (key_frame_info, video_clip, target) in enumerate(self.streamloader):
 
             # ex: video_id: 1204, sec: 900
             if iter_i == 0:
@@ -230,23 +269,18 @@ class AVA_Evaluator(object):
                 model.initialization = True
 
             # prepare
-            video_clip = video_clip.unsqueeze(0).to(self.device)  # [B, T, 3, H, W], B=1
+            video_clip = video_clip.unsqueeze(0).to(self.device, non_blocking=True)  # [B, T, 3, H, W], B=1
 
             with torch.no_grad():
                 # inference
                 bboxes = model(video_clip)
 
-                # process batch
-                preds_list = []
-
                 # video info
                 video_idx = key_frame_info[0]
                 sec = key_frame_info[1]
 
-                # [[[x1, y1, x2, y2], cls_out, [video_idx, sec]], ...]
-                preds_list = [[bbox[:4].tolist(), bbox[4:], [video_idx, sec]] for bbox in bboxes]
-
-            self.update_stats(preds_list)
+            # boxes: [N, 4], cls_out: [N, C]
+            self.update_stats(bboxes[:, :4], bboxes[:, 4:], [video_idx, sec])
             if iter_i % 500 == 0:
                 log_info = "[%d / %d]" % (iter_i, len(self.testset))
                 print(log_info, flush=True)
@@ -255,8 +289,7 @@ class AVA_Evaluator(object):
         print("mAP: {}".format(mAP))
 
         # clear
-        del self.all_preds
-        self.all_preds = []
+        self.reset_stats()
 
         return mAP
 
@@ -277,7 +310,6 @@ class AVA_Evaluator(object):
                 batch_output = model(batch_video_clip)
 
                 # process batch
-                preds_list = []
                 for bi in range(len(batch_output)):
                     out_bboxes = batch_output[bi]
                     key_frame_info = batch_key_frame_info[bi]
@@ -286,13 +318,9 @@ class AVA_Evaluator(object):
                     video_idx = key_frame_info[0]
                     sec = key_frame_info[1]
 
-                    for bbox in out_bboxes:
-                        x1, y1, x2, y2 = bbox[:4].tolist()
-                        cls_out = bbox[4:]
-
-                        preds_list.append([[x1, y1, x2, y2], cls_out, [video_idx, sec]])
+                    # boxes: [N, 4], cls_out: [N, C]
+                    self.update_stats(out_bboxes[:, :4], out_bboxes[:, 4:], [video_idx, sec])
 
-            self.update_stats(preds_list)
             if iter_i % 100 == 0:
                 log_info = "[%d / %d]" % (iter_i, len(self.testloader))
                 print(log_info, flush=True)
@@ -301,7 +329,6 @@ class AVA_Evaluator(object):
         print("mAP: {}".format(mAP))
 
         # clear
-        del self.all_preds
-        self.all_preds = []
+        self.reset_stats()
 
         return mAP
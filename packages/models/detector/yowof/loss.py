@@ -1,9 +1,10 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pad_sequence
 from .matcher import UniformMatcher
 
-from ....utils.box_ops import box_iou, generalized_box_iou, box_cxcywh_to_xyxy
-from ....utils.misc import Sigmoid_FocalLoss, AVA_FocalLoss
+from ....utils.box_ops import batch_box_iou, get_ious, box_cxcywh_to_xyxy
+from ....utils.misc import Sigmoid_FocalLoss, Sparse_Sigmoid_FocalLoss, AVA_FocalLoss
 from ....utils.vis_tools import vis_targets
 from ....utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
 
@@ -29,6 +30,9 @@ class Criterion(object):
         # loss weight
         self.loss_cls_weight = loss_cls_weight
         self.loss_reg_weight = loss_reg_weight
+        # anchor boxes in x1y1x2y2, cached on the first call
+        self.anchors = None
+        self.anchor_boxes_xyxy = None
         # matcher
         self.matcher = UniformMatcher(match_times=cfg['topk'])
         # loss
@@ -36,9 +40,9 @@ class Criterion(object):
             self.cls_loss = AVA_FocalLoss(device=device, gamma=0.5, num_classes=num_classes, reduction='none')
             # self.cls_loss = Sigmoid_FocalLoss(alpha=alpha, gamma=gamma, reduction='none')
         else:
-            self.cls_loss = Sigmoid_FocalLoss(alpha=alpha, gamma=gamma, reduction='none')
+            self.cls_loss = Sparse_Sigmoid_FocalLoss(alpha=alpha, gamma=gamma, reduction='none')
 
-    def prepare_targets(self, cls_pred_shape, targets, indices, src_idx, ignore_idx, pos_ignore_idx):
+    def prepare_targets(self, cls_pred_shape, tgt_cls_o, src_idx, ignore_idx, pos_ignore_idx):
         if self.multi_hot:
             # gt_cls: 0 -> bg; 1 -> fg; -1 -> ignore;
             # [BM, C]
@@ -46,8 +50,7 @@ class Criterion(object):
                                  dtype=torch.int64,
                                  device=self.device)
             gt_cls[ignore_idx, :] = -1
-            # [BN, C]
-            tgt_cls_o = torch.cat([t['labels'][J] for t, (_, J) in zip(targets, indices)])
+            # [P, C]
             tgt_cls_o[pos_ignore_idx, :] = -1
             gt_cls[src_idx] = tgt_cls_o.to(self.device)
 
@@ -62,7 +65,7 @@ class Criterion(object):
                                 dtype=torch.int64,
                                 device=self.device)
             gt_cls[ignore_idx] = -1
-            tgt_cls_o = torch.cat([t['labels'][J] for t, (_, J) in zip(targets, indices)])
+            # [P,]
             tgt_cls_o[pos_ignore_idx] = -1
 
             gt_cls[src_idx] = tgt_cls_o.to(self.device)
@@ -72,7 +75,8 @@ class Criterion(object):
 
         if is_dist_avail_and_initialized():
             torch.distributed.all_reduce(num_foreground)
-        num_foreground = torch.clamp(num_foreground / get_world_size(), min=1).item()
+        # keep it as a tensor, .item() would block on the device every iteration
+        num_foreground = torch.clamp(num_foreground / get_world_size(), min=1)
 
         return gt_cls, foreground_idxs, num_foreground
 
@@ -84,10 +88,10 @@ class Criterion(object):
         return loss_labels
 
     def loss_bboxes(self, pred_box, tgt_boxes, num_boxes):
-        # giou
-        gious = generalized_box_iou(pred_box, tgt_boxes)  # [N, M]
+        # giou between the matched pairs
+        gious = get_ious(pred_box, tgt_boxes, box_mode="xyxy", iou_type='giou')  # [N,]
         # giou loss
-        loss_bboxes = 1. - torch.diag(gious)
+        loss_bboxes = 1. - gious
         loss_bboxes = loss_bboxes.sum() / num_boxes
 
         return loss_bboxes
@@ -104,58 +108,54 @@ class Criterion(object):
         box_pred = outputs['box_preds']
         cls_pred = outputs['cls_preds']
         anchor_boxes = outputs['anchors']
-        batch_size = len(targets)
-        targets = [{k: v.to(box_pred.device) for k, v in t.items()} for t in targets]
+        device = box_pred.device
 
-        # rescale tgt box
-        rescale_tgt = []
-        for tgt in targets:
-            tgt['boxes'] = tgt['boxes'] * self.img_size
-            rescale_tgt.append(tgt)
-        targets = rescale_tgt
+        # pad tgt boxes: List[N_i, 4] -> [B, N_max, 4], and rescale them
+        tgt_boxes_pad = pad_sequence([t['boxes'] for t in targets], batch_first=True)
+        tgt_boxes_pad = tgt_boxes_pad.to(device) * self.img_size
+        max_num_tgts = tgt_boxes_pad.size(1)
+        num_tgts = torch.as_tensor([len(t['boxes']) for t in targets], device=device)
+        tgt_mask = torch.arange(max_num_tgts, device=device)[None] < num_tgts[:, None]
+        # List[N_i, ...] -> [N_1 + ... + N_B, ...]
+        tgt_labels = torch.cat([t['labels'] for t in targets]).to(device)
 
         # Matcher for this frame
-        indices = self.matcher(
+        batch_idx, pos_src_idx, pos_tgt_idx = self.matcher(
             pred_boxes=box_pred,
             anchor_boxes=anchor_boxes,
-            targets=targets)
-
-        # convert cxcywh to x1y1x2y2
-        anchor_boxes = box_cxcywh_to_xyxy(anchor_boxes)
-
-        # [M, 4] -> [1, M, 4] -> [B, M, 4]
-        anchor_boxes = anchor_boxes[None].repeat(batch_size, 1, 1)
-
-        ious = []
-        pos_ious = []
-        for batch_index in range(batch_size):
-            src_idx, tgt_idx = indices[batch_index]
-            # iou between predbox and tgt box
-            iou, _ = box_iou(box_pred[batch_index, ...],
-                             targets[batch_index]['boxes'].clone())
-            if iou.numel() == 0:
-                max_iou = iou.new_full((iou.size(0),), 0)
+            tgt_boxes=tgt_boxes_pad,
+            num_tgts=num_tgts)
+
+        # convert cxcywh to x1y1x2y2, the anchors are fixed so it is only done once
+        if self.anchors is not anchor_boxes:
+            self.anchors = anchor_boxes
+            # [M, 4] -> [1, M, 4], broadcast over the batch
+            self.anchor_boxes_xyxy = box_cxcywh_to_xyxy(anchor_boxes)[None]
+        anchor_boxes = self.anchor_boxes_xyxy
+
+        with torch.no_grad():
+            # iou between predbox and tgt box: [B, M, N_max]
+            ious = batch_box_iou(box_pred.detach(), tgt_boxes_pad)
+            ious = ious.masked_fill(~tgt_mask[:, None, :], 0.)
+            if max_num_tgts == 0:
+                max_ious = ious.new_zeros(ious.shape[:2])
             else:
-                max_iou = iou.max(dim=1)[0]
+                max_ious = ious.max(dim=-1)[0]
 
-            # iou between anchorbox and tgt box
-            a_iou, _ = box_iou(anchor_boxes[batch_index],
-                               targets[batch_index]['boxes'].clone())
-            if a_iou.numel() == 0:
-                pos_iou = a_iou.new_full((0,), 0)
-            else:
-                pos_iou = a_iou[src_idx, tgt_idx]
-            ious.append(max_iou)
-            pos_ious.append(pos_iou)
+            # iou between anchorbox and tgt box: [B, M, N_max]
+            a_ious = batch_box_iou(anchor_boxes, tgt_boxes_pad)
+            pos_ious = a_ious[batch_idx, pos_src_idx, pos_tgt_idx]
 
-        ious = torch.cat(ious)
-        ignore_idx = ious > self.cfg['igt']
-        pos_ious = torch.cat(pos_ious)
+        # [B, M] -> [BM,]
+        ignore_idx = max_ious.flatten() > self.cfg['igt']
         pos_ignore_idx = pos_ious < self.cfg['iou_t']
 
-        src_idx = torch.cat(
-            [src + idx * anchor_boxes[0].shape[0] for idx, (src, _) in
-             enumerate(indices)])
+        # [P,] index into the flattened [BM,] anchors
+        src_idx = batch_idx * anchor_boxes.shape[1] + pos_src_idx
+
+        # [P,] index into the concatenated tgts of all images
+        tgt_idx = (num_tgts.cumsum(0) - num_tgts)[batch_idx] + pos_tgt_idx
+        tgt_cls_o = tgt_labels[tgt_idx]
 
         # [B, M, 4] -> [BM, 4]
         cls_pred = cls_pred.view(-1, self.num_classes)
@@ -167,8 +167,7 @@ class Criterion(object):
             num_foreground
         ) = self.prepare_targets(
             cls_pred_shape=cls_pred.shape,
-            targets=targets,
-            indices=indices,
+            tgt_cls_o=tgt_cls_o,
             src_idx=src_idx,
             ignore_idx=ignore_idx,
             pos_ignore_idx=pos_ignore_idx
@@ -176,21 +175,19 @@ class Criterion(object):
 
         # class loss
         if self.multi_hot:
+            # valid rows of gt_cls are already 0/1 multi-hot labels
             valid_idxs = (torch.sum(gt_cls, dim=-1) >= 0)
-            tgt_labels = torch.zeros_like(cls_pred)
-            tgt_labels[foreground_idxs] = gt_cls[foreground_idxs].float()
+            valid_tgt_labels = gt_cls[valid_idxs].float()
 
         else:
+            # class ids, the focal loss never builds the one-hot targets
             valid_idxs = gt_cls >= 0
-            tgt_labels = torch.zeros_like(cls_pred)
-            tgt_labels[foreground_idxs, gt_cls[foreground_idxs]] = 1
+            valid_tgt_labels = gt_cls[valid_idxs]
         valid_cls_pred = cls_pred[valid_idxs]
-        valid_tgt_labels = tgt_labels[valid_idxs]
         loss_labels = self.loss_labels(valid_cls_pred, valid_tgt_labels, num_foreground)
 
         # bbox loss
-        tgt_boxes = torch.cat([t['boxes'][i]
-                               for t, (_, i) in zip(targets, indices)], dim=0).to(self.device)
+        tgt_boxes = tgt_boxes_pad[batch_idx, pos_tgt_idx]
         tgt_boxes = tgt_boxes[~pos_ignore_idx]
         matched_pred_box = box_pred.reshape(-1, 4)[src_idx[~pos_ignore_idx]]
         loss_bboxes = self.loss_bboxes(matched_pred_box, tgt_boxes, num_foreground)
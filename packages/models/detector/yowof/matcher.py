@@ -1,4 +1,3 @@
-import numpy as np
 import torch
 
 from ....utils.box_ops import box_xyxy_to_cxcywh
@@ -16,91 +15,45 @@ class UniformMatcher(object):
         self.match_times = match_times
 
     @torch.no_grad()
-    def __call__(self, pred_boxes, anchor_boxes, targets):
+    def __call__(self, pred_boxes, anchor_boxes, tgt_boxes, num_tgts):
         """
             pred_boxes: (Tensor)   [B, num_queries, 4]
             anchor_boxes: (Tensor) [num_queries, 4]
-            targets: (Dict) dict{'boxes': [...], 
-                                 'labels': [...]}
+            tgt_boxes: (Tensor)    [B, N_max, 4], zero padded
+            num_tgts: (Tensor)     [B,], the number of object instances in each image
+        Output:
+            batch_idx, src_idx, tgt_idx: (Tensor) [P,], P = num of positive samples
         """
 
         bs, num_queries = pred_boxes.shape[:2]
 
-        # We flatten to compute the cost matrices in a batch
-        # [B, num_queries, 4] -> [M, 4]
-        out_bbox = pred_boxes.flatten(0, 1)
-        # [num_queries, 4] -> [1, num_queries, 4] -> [B, num_queries, 4] -> [M, 4]
-        anchor_boxes = anchor_boxes[None].repeat(bs, 1, 1)
-        anchor_boxes = anchor_boxes.flatten(0, 1)
-
-        # Also concat the target boxes
-        tgt_bbox = torch.cat([v['boxes'] for v in targets])
+        max_num_tgts = tgt_boxes.size(1)
+        tgt_bbox = box_xyxy_to_cxcywh(tgt_boxes)
 
         # Compute the L1 cost between boxes
         # Note that we use anchors and predict boxes both
-        cost_bbox = torch.cdist(box_xyxy_to_cxcywh(out_bbox),
-                                box_xyxy_to_cxcywh(tgt_bbox),
+        # [B, M, N_max], M=num_queries, N_max=max num_tgt
+        cost_bbox = torch.cdist(box_xyxy_to_cxcywh(pred_boxes),
+                                tgt_bbox,
                                 p=1)
-        cost_bbox_anchors = torch.cdist(anchor_boxes,
-                                        box_xyxy_to_cxcywh(tgt_bbox),
+        cost_bbox_anchors = torch.cdist(anchor_boxes[None].expand(bs, -1, -1),
+                                        tgt_bbox,
                                         p=1)
 
-        # Final cost matrix: [B, M, N], M=num_queries, N=num_tgt
-        C = cost_bbox
-        C = C.view(bs, num_queries, -1).cpu()
-        C1 = cost_bbox_anchors
-        C1 = C1.view(bs, num_queries, -1).cpu()
-
-        sizes = [len(v['boxes']) for v in targets]  # the number of object instances in each image
-        all_indices_list = [[] for _ in range(bs)]
-        # positive indices when matching predict boxes and gt boxes
-        # len(indices) = batch size
-        # len(tupe) = topk
-        indices = [
-            tuple(
-                torch.topk(
-                    c[i],
-                    k=self.match_times,
-                    dim=0,
-                    largest=False)[1].numpy().tolist()
-            )
-            for i, c in enumerate(C.split(sizes, -1))
-        ]
-        # positive indices when matching anchor boxes and gt boxes
-        indices1 = [
-            tuple(
-                torch.topk(
-                    c[i],
-                    k=self.match_times,
-                    dim=0,
-                    largest=False)[1].numpy().tolist())
-            for i, c in enumerate(C1.split(sizes, -1))]
-
-        # concat the indices according to image ids
-        # img_id = batch_id
-        for img_id, (idx, idx1) in enumerate(zip(indices, indices1)):
-            img_idx_i = [
-                np.array(idx_ + idx1_)
-                for (idx_, idx1_) in zip(idx, idx1)
-            ]  # 'i' is the index of queris
-            img_idx_j = [
-                np.array(list(range(len(idx_))) + list(range(len(idx1_))))
-                for (idx_, idx1_) in zip(idx, idx1)
-            ]  # 'j' is the index of tgt
-            all_indices_list[img_id] = [*zip(img_idx_i, img_idx_j)]
-
-        # re-organize the positive indices
-        all_indices = []
-        for img_id in range(bs):
-            all_idx_i = []
-            all_idx_j = []
-            for idx_list in all_indices_list[img_id]:
-                idx_i, idx_j = idx_list
-                all_idx_i.append(idx_i)
-                all_idx_j.append(idx_j)
-            all_idx_i = np.hstack(all_idx_i)
-            all_idx_j = np.hstack(all_idx_j)
-            all_indices.append((all_idx_i, all_idx_j))
-
-        return [(torch.as_tensor(i, dtype=torch.int64),
-                 torch.as_tensor(j, dtype=torch.int64)) for i, j in all_indices]
+        # positive indices when matching predict boxes / anchor boxes and gt boxes
+        # [B, topk, N_max]
+        indices = torch.topk(cost_bbox, k=self.match_times, dim=1, largest=False)[1]
+        indices1 = torch.topk(cost_bbox_anchors, k=self.match_times, dim=1, largest=False)[1]
+        # [B, topk, 2, N_max]
+        all_indices = torch.stack([indices, indices1], dim=2)
+
+        # flatten the indices of all images, the padded tgts are dropped
+        # [B, topk, 2, N_max] -> [B, topk*2*N_max]
+        src_idx = all_indices.flatten(1)
+        tgt_idx = torch.arange(max_num_tgts, device=pred_boxes.device).repeat(self.match_times * 2)
+        tgt_idx = tgt_idx[None].expand(bs, -1)
+        batch_idx = torch.arange(bs, device=pred_boxes.device)[:, None].expand_as(src_idx)
+        valid = tgt_idx < num_tgts[:, None]
+
+        # 'batch_idx' is the index of image, 'src_idx' is the index of queries, 'tgt_idx' is the index of tgt
+        return batch_idx[valid], src_idx[valid], tgt_idx[valid]
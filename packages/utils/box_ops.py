@@ -100,6 +100,28 @@ def box_iou(boxes1, boxes2):
     return iou, union
 
 
+def batch_box_iou(boxes1, boxes2):
+    """
+    Batched version of box_iou. The boxes should be in [x0, y0, x1, y1] format
+        boxes1: (Tensor) [B, N, 4] or [1, N, 4]
+        boxes2: (Tensor) [B, M, 4]
+    Returns a [B, N, M] pairwise matrix.
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])  # [B, N]
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])  # [B, M]
+
+    lt = torch.max(boxes1[:, :, None, :2], boxes2[:, None, :, :2])  # [B,N,M,2]
+    rb = torch.min(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:])  # [B,N,M,2]
+
+    wh = (rb - lt).clamp(min=0)  # [B,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [B,N,M]
+
+    union = area1[:, :, None] + area2[:, None, :] - inter
+
+    iou = inter / union
+    return iou
+
+
 def generalized_box_iou(boxes1, boxes2):
     """
     Generalized IoU from https://giou.stanford.edu/
@@ -1,8 +1,8 @@
 import torch
-from thop import profile
+from torch.profiler import profile
 
 
-def FLOPs_and_Params(model, img_size, len_clip, device):
+def FLOPs_and_Params(model, img_size, len_clip, device, num_warmup=3):
     # set eval mode
     model.trainable = False
     model.eval()
@@ -11,19 +11,31 @@ def FLOPs_and_Params(model, img_size, len_clip, device):
     model.initialization = True
     model.set_inference_mode(mode='stream')
 
-    # generate init video clip
-    video_clip = torch.randn(1, len_clip, 3, img_size, img_size).to(device)
-    outputs = model(video_clip)
-
-    # generate a new frame
-    video_clip = torch.randn(1, len_clip, 3, img_size, img_size).to(device)
-
-    print('==============================')
-    flops, params = profile(model, inputs=(video_clip, ))
+    with torch.no_grad():
+        # generate init video clip
+        video_clip = torch.randn(1, len_clip, 3, img_size, img_size, device=device)
+        outputs = model(video_clip)
+
+        # generate a new frame
+        video_clip = torch.randn(1, len_clip, 3, img_size, img_size, device=device)
+
+        # warmup, so that the cudnn autotuning is not profiled
+        for _ in range(num_warmup):
+            outputs = model(video_clip)
+        if video_clip.is_cuda:
+            torch.cuda.synchronize(video_clip.device)
+
+        print('==============================')
+        with profile(with_flops=True) as prof:
+            model(video_clip)
+    # the profiler counts a multiply-add as 2 flops, thop counted it as 1,
+    # so it is halved to keep the numbers comparable with the reported GFLOPs
+    flops = sum(e.flops for e in prof.key_averages()) / 2
+    params = sum(p.numel() for p in model.parameters())
     print('==============================')
     print('FLOPs : {:.2f} B'.format(flops / 1e9))
     print('Params : {:.2f} M'.format(params / 1e6))
-    
+
     # set train mode.
     model.trainable = True
     model.train()
@@ -3,7 +3,6 @@ import json
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 from torch.utils.data import DataLoader, DistributedSampler
 
 from ..dataset.ucf_jhmdb import UCF_JHMDB_Dataset
@@ -19,7 +18,7 @@ def build_dataset(device, d_cfg, args, is_train=False):
     """
         d_cfg: dataset config
     """
-    # transform
+    # transform, the test transform is only used by the evaluator
     augmentation = Augmentation(
         img_size=d_cfg['train_size'],
         pixel_mean=d_cfg['pixel_mean'],
@@ -29,11 +28,15 @@ def build_dataset(device, d_cfg, args, is_train=False):
         saturation=d_cfg['saturation'],
         exposure=d_cfg['exposure']
     )
-    basetransform = BaseTransform(
-        img_size=d_cfg['test_size'],
-        pixel_mean=d_cfg['pixel_mean'],
-        pixel_std=d_cfg['pixel_std'],
-    )
+    if args.eval:
+        basetransform = BaseTransform(
+            img_size=d_cfg['test_size'],
+            pixel_mean=d_cfg['pixel_mean'],
+            pixel_std=d_cfg['pixel_std'],
+        )
+
+    # the evaluator loads its own test set and annotations, so it is only built for --eval
+    evaluator = None
 
     # dataset
     if args.dataset in ['ucf24', 'jhmdb21']:
@@ -50,18 +53,19 @@ def build_dataset(device, d_cfg, args, is_train=False):
         num_classes = dataset.num_classes
 
         # evaluator
-        evaluator = UCF_JHMDB_Evaluator(
-            device=device,
-            data_root=d_cfg['data_root'],
-            dataset=args.dataset,
-            model_name=args.version,
-            img_size=d_cfg['test_size'],
-            len_clip=d_cfg['len_clip'],
-            conf_thresh=0.01,
-            iou_thresh=0.5,
-            transform=basetransform,
-            gt_folder=d_cfg['gt_folder']
-        )
+        if args.eval:
+            evaluator = UCF_JHMDB_Evaluator(
+                device=device,
+                data_root=d_cfg['data_root'],
+                dataset=args.dataset,
+                model_name=args.version,
+                img_size=d_cfg['test_size'],
+                len_clip=d_cfg['len_clip'],
+                conf_thresh=0.01,
+                iou_thresh=0.5,
+                transform=basetransform,
+                gt_folder=d_cfg['gt_folder']
+            )
 
     elif args.dataset == 'ava_v2.1':
         # dataset
@@ -76,17 +80,18 @@ def build_dataset(device, d_cfg, args, is_train=False):
         num_classes = 80
 
         # evaluator
-        evaluator = AVA_Evaluator(
-            device=device,
-            d_cfg=d_cfg,
-            img_size=d_cfg['test_size'],
-            len_clip=d_cfg['len_clip'],
-            sampling_rate=d_cfg['sampling_rate'],
-            transform=basetransform,
-            collate_fn=CollateFunc(),
-            full_test_on_val=False,
-            version='v2.1'
-        )
+        if args.eval:
+            evaluator = AVA_Evaluator(
+                device=device,
+                d_cfg=d_cfg,
+                img_size=d_cfg['test_size'],
+                len_clip=d_cfg['len_clip'],
+                sampling_rate=d_cfg['sampling_rate'],
+                transform=basetransform,
+                collate_fn=CollateFunc(),
+                full_test_on_val=False,
+                version='v2.1'
+            )
 
     elif args.dataset == 'ava_v2.2':
         # dataset
@@ -101,17 +106,18 @@ def build_dataset(device, d_cfg, args, is_train=False):
         num_classes = 80
 
         # evaluator
-        evaluator = AVA_Evaluator(
-            device=device,
-            d_cfg=d_cfg,
-            img_size=d_cfg['test_size'],
-            len_clip=d_cfg['len_clip'],
-            sampling_rate=d_cfg['sampling_rate'],
-            transform=basetransform,
-            collate_fn=CollateFunc(),
-            full_test_on_val=False,
-            version='v2.2'
-        )
+        if args.eval:
+            evaluator = AVA_Evaluator(
+                device=device,
+                d_cfg=d_cfg,
+                img_size=d_cfg['test_size'],
+                len_clip=d_cfg['len_clip'],
+                sampling_rate=d_cfg['sampling_rate'],
+                transform=basetransform,
+                collate_fn=CollateFunc(),
+                full_test_on_val=False,
+                version='v2.2'
+            )
 
     elif args.dataset == 'ava_pose':
         # dataset
@@ -126,17 +132,18 @@ def build_dataset(device, d_cfg, args, is_train=False):
         num_classes = 14
 
         # evaluator
-        evaluator = AVA_Evaluator(
-            device=device,
-            d_cfg=d_cfg,
-            img_size=d_cfg['test_size'],
-            len_clip=d_cfg['len_clip'],
-            sampling_rate=d_cfg['sampling_rate'],
-            transform=basetransform,
-            collate_fn=CollateFunc(),
-            full_test_on_val=False,
-            version='pose'
-        )
+        if args.eval:
+            evaluator = AVA_Evaluator(
+                device=device,
+                d_cfg=d_cfg,
+                img_size=d_cfg['test_size'],
+                len_clip=d_cfg['len_clip'],
+                sampling_rate=d_cfg['sampling_rate'],
+                transform=basetransform,
+                collate_fn=CollateFunc(),
+                full_test_on_val=False,
+                version='pose'
+            )
 
     else:
         print('unknow dataset !!')
@@ -146,13 +153,25 @@ def build_dataset(device, d_cfg, args, is_train=False):
     print('Training model on:', args.dataset)
     print('The dataset size:', len(dataset))
 
-    if not args.eval:
-        evaluator = None
-
     return dataset, evaluator, num_classes
 
 
 def build_dataloader(args, dataset, batch_size, collate_fn=None, is_train=False):
+    """
+        The batches are in pinned memory, so the consumers should copy them with
+        .to(device, non_blocking=True) to overlap the copy with the computation.
+    """
+    # the ava transforms are heavier, so it gets more workers by default
+    num_workers = args.num_workers
+    if num_workers is None:
+        num_workers = 8 if args.dataset.startswith('ava') else 4
+
+    # keep the workers alive across epochs instead of re-spawning them
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=True)
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True,
+                             prefetch_factor=args.prefetch_factor)
+
     if is_train:
         # distributed
         if args.distributed:
@@ -163,16 +182,15 @@ def build_dataloader(args, dataset, batch_size, collate_fn=None, is_train=False)
         batch_sampler_train = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=True)
 
         dataloader = DataLoader(dataset, batch_sampler=batch_sampler_train,
-                                collate_fn=collate_fn, num_workers=args.num_workers, pin_memory=True)
+                                collate_fn=collate_fn, **loader_kwargs)
     else:
         # test dataloader
         dataloader = torch.utils.data.DataLoader(
             dataset=dataset,
             shuffle=False,
             collate_fn=collate_fn,
-            num_workers=args.num_workers,
             drop_last=False,
-            pin_memory=True
+            **loader_kwargs
         )
 
     return dataloader
@@ -183,23 +201,24 @@ def load_weight(model, path_to_ckpt=None):
         print('No trained weight ..')
         return model
 
-    checkpoint = torch.load(path_to_ckpt, map_location='cpu')
+    # mmap the tensors from the file instead of reading the whole checkpoint into memory,
+    # the checkpoint keeps the argparse args, so it can not be loaded with weights_only
+    try:
+        checkpoint = torch.load(path_to_ckpt, map_location='cpu', mmap=True, weights_only=False)
+    except (TypeError, RuntimeError):
+        # torch < 2.1, or a checkpoint saved in the legacy format
+        checkpoint = torch.load(path_to_ckpt, map_location='cpu')
     # checkpoint state dict
     checkpoint_state_dict = checkpoint.pop("model")
     # model state dict
     model_state_dict = model.state_dict()
-    # check
-    for k in list(checkpoint_state_dict.keys()):
-        if k in model_state_dict:
-            shape_model = tuple(model_state_dict[k].shape)
-            shape_checkpoint = tuple(checkpoint_state_dict[k].shape)
-            if shape_model != shape_checkpoint:
-                checkpoint_state_dict.pop(k)
-        else:
-            checkpoint_state_dict.pop(k)
-            print(k)
+    # check: keep the params the model has with the same shape
+    filtered_state_dict = {k: v for k, v in checkpoint_state_dict.items()
+                           if k in model_state_dict and model_state_dict[k].shape == v.shape}
+    for k in checkpoint_state_dict.keys() - filtered_state_dict.keys():
+        print(k)
 
-    model.load_state_dict(checkpoint_state_dict)
+    model.load_state_dict(filtered_state_dict, strict=False)
     print('Finished loading model!')
 
     return model
@@ -207,18 +226,8 @@ def load_weight(model, path_to_ckpt=None):
 
 class CollateFunc(object):
     def __call__(self, batch):
-        batch_frame_id = []
-        batch_key_target = []
-        batch_video_clips = []
-
-        for sample in batch:
-            key_frame_id = sample[0]
-            video_clip = sample[1]
-            key_target = sample[2]
-
-            batch_frame_id.append(key_frame_id)
-            batch_video_clips.append(video_clip)
-            batch_key_target.append(key_target)
+        # List[(frame_id, video_clip, key_target)] -> three lists of B items
+        batch_frame_id, batch_video_clips, batch_key_target = map(list, zip(*batch))
 
         # List [B, T, 3, H, W] -> [B, T, 3, H, W]
         batch_video_clips = torch.stack(batch_video_clips)
@@ -226,6 +235,90 @@ class CollateFunc(object):
         return batch_frame_id, batch_video_clips, batch_key_target
 
 
+class CUDAPrefetcher(object):
+    """
+        Copy the next batch to the device on a side stream while the model runs
+        on the current batch. CUDA can not be used in the dataloader workers, so
+        the copy is issued here, in the main process. On cpu it only moves the batch.
+    """
+
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def to_device(self, batch):
+        frame_ids, video_clips, targets = batch
+        video_clips = video_clips.to(self.device, non_blocking=True)
+        targets = [{k: v.to(self.device, non_blocking=True) if torch.is_tensor(v) else v
+                    for k, v in t.items()} for t in targets]
+
+        return frame_ids, video_clips, targets
+
+    def wait(self, batch, copy_done):
+        # the current stream must not read the batch before its copy is done
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(copy_done)
+        # the memory was allocated on the side stream, tell the allocator it is used here
+        _, video_clips, targets = batch
+        video_clips.record_stream(stream)
+        for t in targets:
+            for v in t.values():
+                if torch.is_tensor(v):
+                    v.record_stream(stream)
+
+        return batch
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.dataloader:
+                yield self.to_device(batch)
+            return
+
+        prev = None
+        for batch in self.dataloader:
+            with torch.cuda.stream(self.stream):
+                batch = self.to_device(batch)
+                copy_done = torch.cuda.Event()
+                copy_done.record(self.stream)
+            if prev is not None:
+                yield self.wait(*prev)
+            prev = (batch, copy_done)
+
+        if prev is not None:
+            yield self.wait(*prev)
+
+
+@torch.jit.script
+def ava_focal_loss(logits, targets, weight_pos, weight_neg, gamma: float):
+    """
+        scripted, so that the elementwise ops can be fused
+        logits, targets: [N, C]
+        weight_pos, weight_neg: [C,], class weight of the pos & neg terms
+    """
+    # log(p) and log(1 - p), stable for any logit, no sigmoid is computed
+    log_p = F.logsigmoid(logits)
+    log_1mp = F.logsigmoid(-logits)
+
+    # -log(p_t)
+    ce_loss = -(targets * log_p + (1.0 - targets) * log_1mp)
+
+    # class weight broadcast over the N rows
+    weight = weight_pos * targets + weight_neg * (1.0 - targets)
+
+    # (1 - p_t) ** gamma = exp(gamma * log(1 - p_t)).
+    # gamma < 1, so the pow of a sigmoid that rounds to 1 would give an infinite gradient,
+    # the log-space form stays finite
+    log_1mp_t = targets * log_1mp + (1.0 - targets) * log_p
+    focal_factor = torch.exp(gamma * log_1mp_t)
+
+    # keep the dense [N, C] shape, the targets select the pos & neg terms
+    return ce_loss * focal_factor * weight
+
+
 class AVA_FocalLoss(object):
     """ Focal loss for AVA"""
 
@@ -242,28 +335,16 @@ class AVA_FocalLoss(object):
     def _init_class_weight(self):
         for i in range(1, self.num_classes + 1):
             self.class_weight[i - 1] = 1 - self.class_ratio[str(i)]
+        # the class weight is fixed, so the weights of the pos & neg terms are computed once: [C,]
+        self.weight_pos = torch.exp(self.class_weight)
+        self.weight_neg = torch.exp(1 - self.class_weight)
 
     def __call__(self, logits, targets):
         '''
-        inputs: (N, C) -- result of sigmoid
+        logits: (N, C) -- class pred before sigmoid
         targets: (N, C) -- one-hot variable
         '''
-        # process class pred
-        inputs = torch.clamp(logits.sigmoid(), min=1e-4, max=1 - 1e-4)
-
-        # weight matrix
-        weight_matrix = self.class_weight.expand(logits.size(0), self.num_classes)
-        weight_p1 = torch.exp(weight_matrix[targets == 1])
-        weight_p0 = torch.exp(1 - weight_matrix[targets == 0])
-
-        # pos & neg output
-        p_1 = inputs[targets == 1]
-        p_0 = inputs[targets == 0]
-
-        # loss
-        loss1 = torch.pow(1 - p_1, self.gamma) * torch.log(p_1) * weight_p1
-        loss2 = torch.pow(p_0, self.gamma) * torch.log(1 - p_0) * weight_p0
-        loss = -loss1.sum() - loss2.sum()
+        loss = ava_focal_loss(logits, targets, self.weight_pos, self.weight_neg, float(self.gamma)).sum()
 
         if self.reduction == 'sum':
             loss = loss.sum()
@@ -273,23 +354,88 @@ class AVA_FocalLoss(object):
         return loss
 
 
+@torch.jit.script
+def sigmoid_focal_loss(logits, targets, alpha: float, gamma: float):
+    """ scripted, so that the elementwise ops can be fused """
+    # the bce is written out, so the sigmoid is not computed a second time inside it.
+    # gamma must be >= 1: (1 - p_t) ** gamma reaches a zero base once the sigmoid rounds to 1,
+    # where the gradient is infinite for gamma < 1 (see ava_focal_loss for the log-space form)
+    p = torch.sigmoid(logits)
+    ce_loss = logits.clamp(min=0) - logits * targets + torch.log1p(torch.exp(-logits.abs()))
+    p_t = p * targets + (1.0 - p) * (1.0 - targets)
+    loss = ce_loss * ((1.0 - p_t) ** gamma)
+
+    if alpha >= 0:
+        alpha_t = alpha * targets + (1.0 - alpha) * (1.0 - targets)
+        loss = alpha_t * loss
+
+    return loss
+
+
 class Sigmoid_FocalLoss(object):
     def __init__(self, alpha=0.25, gamma=2.0, reduction='none'):
+        assert gamma >= 1, 'gamma < 1 gives NaN gradients for saturated sigmoids'
         self.alpha = alpha
         self.gamma = gamma
         self.reduction = reduction
 
     def __call__(self, logits, targets):
-        p = torch.sigmoid(logits)
-        ce_loss = F.binary_cross_entropy_with_logits(input=logits,
-                                                     target=targets,
-                                                     reduction="none")
-        p_t = p * targets + (1.0 - p) * (1.0 - targets)
-        loss = ce_loss * ((1.0 - p_t) ** self.gamma)
+        loss = sigmoid_focal_loss(logits, targets, float(self.alpha), float(self.gamma))
+
+        if self.reduction == "mean":
+            loss = loss.mean()
+
+        elif self.reduction == "sum":
+            loss = loss.sum()
+
+        return loss
+
+
+@torch.jit.script
+def sigmoid_focal_loss_sparse(logits, target_idx, alpha: float, gamma: float):
+    """
+        Same as sigmoid_focal_loss with one-hot targets, but takes the class ids
+        and never builds the [N, C] targets.
+        logits: [N, C]
+        target_idx: [N,], C -> bg
+        return: [N,] loss of each row
+    """
+    num_classes = logits.size(1)
+    # every class as negative: bce = -log(1 - p) = softplus(x)
+    p = torch.sigmoid(logits)
+    loss_neg = F.softplus(logits) * p ** gamma
+
+    # swap the negative term of the gt class for the positive one
+    fg = target_idx < num_classes
+    x_t = logits.gather(1, target_idx.clamp(max=num_classes - 1)[:, None]).squeeze(1)
+    p_t = torch.sigmoid(x_t)
+    loss_pos_t = F.softplus(-x_t) * (1.0 - p_t) ** gamma
+    loss_neg_t = F.softplus(x_t) * p_t ** gamma
+
+    if alpha >= 0:
+        loss_neg = (1.0 - alpha) * loss_neg
+        loss_pos_t = alpha * loss_pos_t
+        loss_neg_t = (1.0 - alpha) * loss_neg_t
+
+    loss = loss_neg.sum(dim=1) + (loss_pos_t - loss_neg_t) * fg.to(logits.dtype)
 
-        if self.alpha >= 0:
-            alpha_t = self.alpha * targets + (1.0 - self.alpha) * (1.0 - targets)
-            loss = alpha_t * loss
+    return loss
+
+
+class Sparse_Sigmoid_FocalLoss(object):
+    """ Sigmoid focal loss, targets are the class ids"""
+
+    def __init__(self, alpha=0.25, gamma=2.0, reduction='none'):
+        self.alpha = alpha
+        self.gamma = gamma
+        self.reduction = reduction
+
+    def __call__(self, logits, targets):
+        """
+            logits: (Tensor) [N, C]
+            targets: (Tensor) [N,], C -> bg
+        """
+        loss = sigmoid_focal_loss_sparse(logits, targets, float(self.alpha), float(self.gamma))
 
         if self.reduction == "mean":
             loss = loss.mean()
@@ -306,12 +452,9 @@ class Softmax_FocalLoss(nn.Module):
     def __init__(self, num_classes, alpha=None, gamma=2.0, reduction='none'):
         super(Softmax_FocalLoss, self).__init__()
         if alpha is None:
-            self.alpha = Variable(torch.ones(num_classes, 1))
-        else:
-            if isinstance(alpha, Variable):
-                self.alpha = alpha
-            else:
-                self.alpha = Variable(alpha)
+            alpha = torch.ones(num_classes, 1)
+        # a buffer follows the module in .to(device), so it is not moved in every forward
+        self.register_buffer('alpha', torch.as_tensor(alpha))
         self.gamma = gamma
         self.num_classes = num_classes
         self.reduction = reduction
@@ -321,21 +464,13 @@ class Softmax_FocalLoss(nn.Module):
             inputs: (Tensor): [N, C]
             targets: (Tensor): [N,]
         """
-        N = inputs.size(0)
-        C = inputs.size(1)
-        P = F.softmax(inputs, dim=1)
-
-        class_mask = inputs.data.new(N, C).fill_(0)
-        class_mask = Variable(class_mask)
         ids = targets.view(-1, 1)
-        class_mask.scatter_(1, ids, 1.)
-
-        self.alpha = self.alpha.to(inputs.device)
-        alpha = self.alpha[ids.data.view(-1)]
 
-        probs = (P * class_mask).sum(1).view(-1, 1)
+        alpha = self.alpha[ids.view(-1)]
 
-        log_p = probs.log()
+        # log prob of the gt class: [N, 1]
+        log_p = F.log_softmax(inputs, dim=1).gather(1, ids)
+        probs = log_p.exp()
 
         loss = -alpha * (torch.pow((1 - probs), self.gamma)) * log_p
 
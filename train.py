@@ -8,6 +8,7 @@ import time
 import argparse
 import numpy as np
 from copy import deepcopy
+from contextlib import nullcontext
 import torch
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
@@ -17,7 +18,7 @@ from torch.optim.lr_scheduler import MultiStepLR
 
 from utils import distributed_utils
 from utils.com_flops_params import FLOPs_and_Params
-from utils.misc import CollateFunc, build_dataset, build_dataloader
+from utils.misc import CollateFunc, CUDAPrefetcher, build_dataset, build_dataloader
 from utils.solver.optimizer import build_optimizer
 from utils.solver.warmup_schedule import build_warmup
 
@@ -63,8 +64,10 @@ def parse_args():
     # Dataset
     parser.add_argument('-d', '--dataset', default='ucf24',
                         help='ucf24, jhmdb21, ava_v2.2')
-    parser.add_argument('--num_workers', default=4, type=int, 
-                        help='Number of workers used in dataloading')
+    parser.add_argument('--num_workers', default=None, type=int, 
+                        help='Number of workers used in dataloading, 8 for ava and 4 for the others by default')
+    parser.add_argument('--prefetch_factor', default=2, type=int,
+                        help='Number of batches loaded in advance by each worker')
     
     # DDP train
     parser.add_argument('-dist', '--distributed', action='store_true', default=False,
@@ -123,6 +126,8 @@ def train():
     # dataloader
     each_gpu_batch_size = m_cfg['batch_size'] // distributed_utils.get_world_size()
     dataloader = build_dataloader(args, dataset, each_gpu_batch_size, CollateFunc(), is_train=True)
+    # the batches are copied to the device one step ahead
+    prefetcher = CUDAPrefetcher(dataloader, device)
 
     # build model
     net = build_model(args=args,
@@ -178,7 +183,7 @@ def train():
             dataloader.batch_sampler.sampler.set_epoch(epoch)            
 
         # train one epoch
-        for iter_i, (frame_ids, video_clips, targets) in enumerate(dataloader):
+        for iter_i, (frame_ids, video_clips, targets) in enumerate(prefetcher):
             ni = iter_i + epoch * epoch_size
 
             # warmup
@@ -191,45 +196,49 @@ def train():
                 warmup = False
                 warmup_scheduler.set_lr(optimizer, lr=base_lr, base_lr=base_lr)
 
-            # to device
-            video_clips = video_clips.to(device)
+            # DDP: skip the gradient all-reduce on the accumulation-only iterations
+            if args.distributed and ni % m_cfg['accumulate'] != 0:
+                sync_context = model.no_sync()
+            else:
+                sync_context = nullcontext()
 
-            # inference
-            if args.fp16:
-                with torch.cuda.amp.autocast(enabled=args.fp16):
+            with sync_context:
+                # inference
+                if args.fp16:
+                    with torch.cuda.amp.autocast(enabled=args.fp16):
+                        loss_dict = model(video_clips, targets=targets)
+                else:
                     loss_dict = model(video_clips, targets=targets)
-            else:
-                loss_dict = model(video_clips, targets=targets)
-                
-            losses = loss_dict['losses']
-            losses = losses / m_cfg['accumulate']
-
-            # reduce            
-            loss_dict_reduced = distributed_utils.reduce_dict(loss_dict)
-
-            # check loss
-            if torch.isnan(losses):
-                print('loss is NAN !!')
-                continue
-
-            # Backward and Optimize
-            if args.fp16:
-                scaler.scale(losses).backward()
-
-                # Optimize
-                if ni % m_cfg['accumulate'] == 0:
-                    scaler.step(optimizer)
-                    scaler.update()
-                    optimizer.zero_grad()
-                    
-            else:
-                # Backward
-                losses.backward()
 
-                # Optimize
-                if ni % m_cfg['accumulate'] == 0:
-                    optimizer.step()
-                    optimizer.zero_grad()
+                losses = loss_dict['losses']
+                losses = losses / m_cfg['accumulate']
+
+                # reduce            
+                loss_dict_reduced = distributed_utils.reduce_dict(loss_dict)
+
+                # check loss
+                if torch.isnan(losses):
+                    print('loss is NAN !!')
+                    continue
+
+                # Backward and Optimize
+                if args.fp16:
+                    scaler.scale(losses).backward()
+
+                    # Optimize
+                    if ni % m_cfg['accumulate'] == 0:
+                        scaler.step(optimizer)
+                        scaler.update()
+                        optimizer.zero_grad()
+
+                else:
+                    # Backward
+                    losses.backward()
+
+                    # Optimize
+                    if ni % m_cfg['accumulate'] == 0:
+                        optimizer.step()
+                        optimizer.zero_grad()
 
             # Display
             if distributed_utils.is_main_process() and iter_i % 10 == 0: